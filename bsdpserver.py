@@ -59,34 +59,97 @@ from pydhcplib.dhcp_packet import *
 from pydhcplib.dhcp_network import *
 from urlparse import urlparse
 
-import socket, struct, fcntl
-import os, fnmatch
+import socket, select, struct, fcntl
+import os, fnmatch, time
 import plistlib
+import csv, json
 import logging, optparse
-import signal, errno
+import signal, errno, mmap
+import threading, Queue
+import ctypes, ctypes.util
 from docopt import docopt
 
 platform = sys.platform
 
 usage = """Usage: bsdpyserver.py [-p <path>] [-r <protocol>] [-i <interface>]
+                        [--prewarm <mb>] [--capture <file>]
+                        [--workers <n>] [--queue <n>] [--bpf]
+                        [--pidfile <file>] [--takeover] [--catalog <file>]
+       bsdpyserver.py --replay <file> [-p <path>] [-r <protocol>]
+                        [-i <interface>] [--speed <factor>]
+                        [--record <file>] [--golden <file>]
+       bsdpyserver.py --publish <file> [-p <path>]
+       bsdpyserver.py --evaluate <inventory> [-p <path>] [--previous <path>]
+                        [--report <file>] [--json]
 
 Run the BSDP server and handle requests from client. Optional parameters are
 the root path to serve NBIs from, the protocol to serve them with and the
 interface to run on.
 
+To restart without missing requests, start the new server with --takeover. It
+scans its boot images and binds port 67 alongside the running server first,
+and only then tells the old server to answer its queued requests and exit. The
+same draining happens on any TERM signal. Servers from releases that did not
+write a pidfile have to be stopped before starting a new one.
+
+Hosts running several servers can have the NBIs under the root path compiled
+once into a catalog file with --publish and start each server with --catalog
+to serve that file instead of scanning the root path themselves. The servers
+share one read-only copy of it in memory. Publishing again replaces the file
+atomically with a new generation, which running servers pick up within a
+second of their next request. Give each server its own pidfile with --pidfile,
+since a server started with --takeover replaces the one running under the same
+pidfile. All servers bind port 67 with SO_REUSEPORT, so every one of them gets
+its own copy of broadcast INFORM requests and replies to it.
+
+Every received BSDP packet can be written to a capture file with --capture.
+Such a file can later be fed through the reply engine with --replay, which needs
+no root privileges or network interface. Replies carry the server address
+192.0.2.1 unless $DOCKER_BSDPY_IP is set. The replies can be recorded and
+compared against the replies recorded in an earlier run, and the replay
+throughput is reported.
+
+The server logs to /var/log/bsdpserver.log. --replay, --publish and --evaluate
+only log warnings and errors, to standard error.
+
+With --evaluate the NBIs under the root path are matched against an inventory
+of Macs to report which images and which default image each of them will see,
+optionally compared with the NBIs under a previous root path. The inventory is
+a CSV file with 'model' and 'mac' columns or a JSON list of objects with those
+keys. The report is written as CSV, or as JSON with --json or if the report
+file ends in .json.
+
 Options:
  -h --help               This screen.
  -p --path <path>        The path to serve NBIs from. [default: /nbi]
  -r --proto <protocol>   The protocol to serve NBIs with. [default: http]
  -i --iface <interface>  The interface to bind to. [default: eth0]
+ --prewarm <mb>          Page cache budget in MB for prewarming boot images,
+                         0 disables prewarming. [default: 2048]
+ --capture <file>        Write every received BSDP packet to a capture file.
+ --workers <n>           Number of threads answering requests. [default: 4]
+ --queue <n>             Number of requests that can wait for a worker before
+                         new ones are dropped. [default: 128]
+ --bpf                   Have the kernel drop everything but BSDP INFORM
+                         packets before they reach BSDPy (Linux only).
+ --pidfile <file>        Where to write the server's process ID.
+                         [default: /var/run/bsdpserver.pid]
+ --takeover              Take over from the server running under the same
+                         pidfile without interrupting service.
+ --catalog <file>        Serve the NBIs in a catalog file written by --publish.
+ --publish <file>        Compile the NBIs under the root path into a catalog.
+ --replay <file>         Replay a capture file instead of serving requests.
+ --speed <factor>        Replay speed relative to the original packet timing,
+                         0 replays as fast as possible. [default: 0]
+ --record <file>         Write the replies of a replay to a capture file.
+ --golden <file>         Compare the replies of a replay with this capture.
+ --evaluate <inventory>  Report the image entitlements for an inventory file.
+ --previous <path>       An earlier NBI root path to compare entitlements with.
+ --report <file>         Write the entitlement report to a file instead of
+                         standard output.
+ --json                  Write the entitlement report as JSON.
 """
 
-logging.basicConfig(format='%(asctime)s - %(levelname)s: %(message)s',
-                    level=logging.DEBUG,
-                    filename='/var/log/bsdpserver.log',
-                    datefmt='%m/%d/%Y %I:%M:%S %p')
-
-
 # A dict that holds mappings of the BSDP option codes for lookup later on
 bsdpoptioncodes = {1: 'message_type',
                    2: 'version',
@@ -108,6 +171,56 @@ netopt = {'client_listen_port':"68",
            'server_listen_port':"67",
            'listen_address':"0.0.0.0"}
 
+# Capture files start with CAPTUREMAGIC and a format version, followed by one
+#   CAPTURERECORD header per packet: a timestamp, the IPv4 address and port the
+#   packet came from (or was sent to, for replies) and the packet length.
+CAPTUREMAGIC = 'BSDPYCAP'
+CAPTUREVERSION = 1
+CAPTURERECORD = struct.Struct('!d4sHI')
+
+# The server address replies carry when replaying without $DOCKER_BSDPY_IP, an
+#   address reserved for documentation (RFC 5737) so no interface is needed
+REPLAYSERVERIP = '192.0.2.1'
+
+# Compiled catalogs, see publishCatalog(), start with a CATALOGHEADER: magic,
+#   format version, generation, image count, the length of every bitmask in
+#   bytes, the offset of the mask of MAC restricted images and the offsets and
+#   entry counts of the image, system ID and MAC address tables. Each image is
+#   a CATALOGIMAGE of its ID, IsDefault flag and the offset and length of its
+#   CATALOGFIELDS in the string pool, CATALOGNOFIELD marking absent fields.
+#   The system ID and MAC address tables are CATALOGKEY entries, sorted by
+#   key: the offset and length of the key and the offset of its bitmask.
+CATALOGMAGIC = 'BSDPYNBI'
+CATALOGVERSION = 1
+CATALOGHEADER = struct.Struct('!8sIQIIIIIIII')
+CATALOGFIELDS = ('name', 'description', 'booter', 'dmg', 'dmgfile', 'proto')
+CATALOGIMAGE = struct.Struct('!IB' + 'II' * len(CATALOGFIELDS))
+CATALOGKEY = struct.Struct('!III')
+CATALOGNOFIELD = 0xffffffff
+
+# The smallest message every DHCP client must accept, in bytes, including the
+#   IP and UDP headers
+DHCPMINMESSAGESIZE = 576
+
+# The SO_REUSEPORT socket option, which the Python 2 socket module lacks
+SO_REUSEPORT = {'linux2': 15, 'linux': 15, 'darwin': 0x200}
+
+# Linux socket option to attach a classic BPF program to a socket, see
+#   compileBsdpFilter().
+SO_ATTACH_FILTER = 26
+
+# posix_fadvise() advice values asking the kernel to start reading a file into
+#   the page cache, used to prewarm boot images before clients ask for them,
+#   and to drop a file from the page cache again.
+POSIX_FADV_WILLNEED = 3
+POSIX_FADV_DONTNEED = 4
+
+# The C library is used for posix_fadvise(), which Python 2 does not expose.
+try:
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+except OSError:
+    libc = None
+
 
 def get_ip(iface=''):
     """
@@ -126,41 +239,46 @@ def get_ip(iface=''):
     ip = struct.unpack('16sH2x4s8x', res)[2]
     return socket.inet_ntoa(ip)
 
-arguments = docopt(usage, version='0.0.1')
-
-# Set the root path that NBIs will be served out of, either provided at
-#  runtime or using a default if none was given. Defaults to /nbi.
+def getServerAddress(serverinterface):
+    """
+        The getServerAddress() function returns the IP address the server
+        identifies itself with in BSDP replies: $DOCKER_BSDPY_IP if it is set,
+        otherwise the address of the network interface BSDPy is running on.
+    """
+    try:
+        if os.environ.get('DOCKER_BSDPY_IP'):
+            externalip = os.environ.get('DOCKER_BSDPY_IP')
+            logging.debug('Found $DOCKER_BSDPY_IP - using custom external IP %s'
+                            % externalip)
+            return externalip
+        elif 'darwin' in platform:
+            from netifaces import ifaddresses
+            logging.debug('Running on OS X, using alternate netifaces method')
+            return ifaddresses(serverinterface)[2][0]['addr']
+        else:
+            myip = get_ip(serverinterface)
+            logging.debug('No BSDPY_IP env var found, using IP from %s interface'
+                            % serverinterface)
+            if myip is None:
+                raise ValueError('no IPv4 address found for interface %s' %
+                                 serverinterface)
+            return myip
+    except:
+        logging.debug('Error setting serverip %s' % sys.exc_info()[1])
+        raise
 
-tftprootpath = arguments['--path']
-bootproto = arguments['--proto']
-serverinterface = arguments['--iface']
 
-# Get the server IP and hostname for use in in BSDP calls later on.
-try:
-    if os.environ.get('DOCKER_BSDPY_IP'):
-        externalip = os.environ.get('DOCKER_BSDPY_IP')
-        serverhostname = externalip
-        serverip = map(int, externalip.split('.'))
-        serverip_str = externalip
-        logging.debug('Found $DOCKER_BSDPY_IP - using custom external IP %s'
-                        % externalip)
-    elif 'darwin' in platform:
-        from netifaces import ifaddresses
-        logging.debug('Running on OS X, using alternate netifaces method')
-        myip = ifaddresses(serverinterface)[2][0]['addr']
-        serverhostname = myip
-        serverip = map(int, myip.split('.'))
-        serverip_str = myip
-    else:
-        myip = get_ip(serverinterface)
-        serverhostname = myip
-        serverip = map(int, myip.split('.'))
-        serverip_str = myip
-        logging.debug('No BSDPY_IP env var found, using IP from %s interface'
-                        % serverinterface)
+def getBaseDmgPath(bootproto, serverip_str, tftprootpath, nbiurl=None):
+    """
+        The getBaseDmgPath() function returns the URL boot image paths are
+        appended to, based on the protocol used to serve them. For HTTP this
+        is $DOCKER_BSDPY_NBI_URL (passed in parsed as nbiurl) if it is set,
+        with its hostname resolved since the EFI BSDP client does no DNS
+        lookups, or else the server's own address.
+    """
+    basedmgpath = None
     if 'http' in bootproto:
-        if os.environ.get('DOCKER_BSDPY_NBI_URL'):
-            nbiurl = urlparse(os.environ.get('DOCKER_BSDPY_NBI_URL'))
+        if nbiurl is not None:
             nbiurlhostname = nbiurl.hostname
 
             # EFI bsdp client doesn't do DNS lookup, so we must do it
@@ -175,38 +293,6 @@ try:
         else:
             basedmgpath = 'http://' + serverip_str + '/'
             logging.debug('Using HTTP basedmgpath %s' % basedmgpath)
-    if 'nfs' in bootproto:
-        basedmgpath = 'nfs:' + serverip_str + ':' + tftprootpath + ':'
-        logging.debug('Using NFS basedmgpath %s' % basedmgpath)
-    logging.debug('Server IP: ' + serverip_str + '\n' +
-                  'Server FQDN: ' + serverhostname + '\n' +
-                  'Serving on ' + serverinterface + '\n' +
-                  'Using ' + bootproto + ' to serve boot image.\n')
-except:
-    logging.debug('Error setting serverip, serverhostname or basedmgpath %s' %
-                    sys.exc_info()[1])
-    raise
-
-
-def getBaseDmgPath(nbiurl) :
-
-    logging.debug('*********\nRefreshing basedmgpath because DOCKER_BSDPY_NBI_URL uses hostname, not IP')
-    if 'http' in bootproto:
-        if os.environ.get('DOCKER_BSDPY_NBI_URL'):
-            nbiurlhostname = nbiurl.hostname
-
-            # EFI bsdp client doesn't do DNS lookup, so we must do it
-            try:
-                socket.inet_aton(nbiurlhostname)
-            except socket.error:
-                nbiurlhostname = socket.gethostbyname(nbiurlhostname)
-                logging.debug('Resolving hostname to IP - %s -> %s' % (nbiurl.hostname, nbiurlhostname))
-
-            basedmgpath = 'http://%s%s/' % (nbiurlhostname, nbiurl.path)
-            logging.debug('Found DOCKER_BSDPY_NBI_URL - using basedmgpath %s\n*********\n' % basedmgpath)
-        else:
-            basedmgpath = 'http://' + serverip_str + '/'
-            logging.debug('Using HTTP basedmgpath %s\n*********\n' % basedmgpath)
 
     if 'nfs' in bootproto:
         basedmgpath = 'nfs:' + serverip_str + ':' + tftprootpath + ':'
@@ -214,6 +300,125 @@ def getBaseDmgPath(nbiurl) :
 
     return basedmgpath
 
+def compileBsdpFilter(maxoptions=32):
+    """
+        The compileBsdpFilter() function returns a classic BPF program, as a
+        list of (code, jt, jf, k) instructions, that accepts only DHCPINFORM
+        packets whose vendor class identifier starts with AAPLBSDPC.
+
+        On a UDP socket the program sees the packet from the UDP header on, so
+        the DHCP header starts at offset 8 and the DHCP options at offset 248,
+        after the magic cookie. Classic BPF can only jump forward, so the walk
+        over the options is unrolled for the first maxoptions options; the
+        offset of the current option is kept in the X register and whether
+        the message type and vendor class matched in scratch memory M[0] and
+        M[1]. Conditional jumps can only skip 255 instructions, so jumps out
+        of an option go through unconditional jumps at the end of it.
+    """
+    # Instruction codes, from linux/filter.h
+    LD_W_ABS, LD_B_ABS, LD_W_IND, LD_B_IND = 0x20, 0x30, 0x40, 0x50
+    LD_IMM, LD_MEM, LDX_IMM, ST = 0x00, 0x60, 0x01, 0x02
+    ADD_K, ADD_X, TAX, TXA = 0x04, 0x0c, 0x07, 0x87
+    JA, JEQ_K, RET_K = 0x05, 0x15, 0x06
+
+    DHCP = 8
+    OPTIONS = DHCP + 240
+
+    program = []
+    labels = {}
+
+    def emit(code, k=0, jt=None, jf=None):
+        program.append([code, jt, jf, k])
+
+    def label(name):
+        labels[name] = len(program)
+
+    # BOOTREQUEST with the DHCP magic cookie
+    emit(LD_B_ABS, DHCP)
+    emit(JEQ_K, 1, None, 'notdhcp')
+    emit(LD_W_ABS, DHCP + 236)
+    emit(JEQ_K, 0x63825363, 'dhcp')
+    label('notdhcp')
+    emit(RET_K, 0)
+
+    label('dhcp')
+    emit(LD_IMM, 0)
+    emit(ST, 0)
+    emit(ST, 1)
+    emit(LDX_IMM, 0)
+
+    for i in range(maxoptions):
+        label('option%d' % i)
+        emit(LD_B_IND, OPTIONS)
+        emit(JEQ_K, 255, 'end%d' % i)
+        emit(JEQ_K, 0, 'pad%d' % i)
+        emit(JEQ_K, 53, 'type%d' % i)
+        emit(JEQ_K, 60, 'vendor%d' % i)
+        emit(JA, 'next%d' % i)
+
+        # Pad options are a single byte
+        label('pad%d' % i)
+        emit(TXA)
+        emit(ADD_K, 1)
+        emit(TAX)
+        emit(JA, 'option%d' % (i + 1))
+
+        # DHCP message type 8 is DHCPINFORM
+        label('type%d' % i)
+        emit(LD_B_IND, OPTIONS + 2)
+        emit(JEQ_K, 8, None, 'reject%d' % i)
+        emit(LD_IMM, 1)
+        emit(ST, 0)
+        emit(JA, 'next%d' % i)
+
+        # 'AAPL' 'BSDP' 'C'
+        label('vendor%d' % i)
+        emit(LD_W_IND, OPTIONS + 2)
+        emit(JEQ_K, 0x4141504c, None, 'reject%d' % i)
+        emit(LD_W_IND, OPTIONS + 6)
+        emit(JEQ_K, 0x42534450, None, 'reject%d' % i)
+        emit(LD_B_IND, OPTIONS + 10)
+        emit(JEQ_K, 0x43, None, 'reject%d' % i)
+        emit(LD_IMM, 1)
+        emit(ST, 1)
+
+        # Move X past the code, length and data of this option
+        label('next%d' % i)
+        emit(LD_B_IND, OPTIONS + 1)
+        emit(ADD_K, 2)
+        emit(ADD_X)
+        emit(TAX)
+        emit(JA, 'option%d' % (i + 1))
+
+        label('end%d' % i)
+        emit(JA, 'end')
+        label('reject%d' % i)
+        emit(JA, 'reject')
+
+    label('option%d' % maxoptions)
+    label('end')
+    emit(LD_MEM, 0)
+    emit(JEQ_K, 0, 'reject')
+    emit(LD_MEM, 1)
+    emit(JEQ_K, 0, 'reject')
+    emit(RET_K, 0x40000)
+    label('reject')
+    emit(RET_K, 0)
+
+    # Resolve labels into jump offsets, which count from the next instruction
+    instructions = []
+    for position, (code, jt, jf, k) in enumerate(program):
+        if code == JA:
+            k = labels[k] - position - 1
+        jt = jt and labels[jt] - position - 1 or 0
+        jf = jf and labels[jf] - position - 1 or 0
+        if not (0 <= jt <= 255 and 0 <= jf <= 255 and k >= 0):
+            raise ValueError('BPF jump out of range at %d' % position)
+        instructions.append((code, jt, jf, k))
+
+    return instructions
+
+
 # Invoke the DhcpServer class from pydhcplib and configure it, overloading the
 #   available class functions to only listen to DHCP INFORM packets, which is
 #   what BSDP uses to do its thing - HandleDhcpInform().
@@ -236,19 +441,179 @@ class DhcpServer(DhcpNetwork) :
             self.DisableReuseaddr()
 
         self.CreateSocket()
+
+        # SO_REUSEPORT lets a restarted server bind port 67 while the old one
+        #   is still answering requests, see takeover in main()
+        if platform in SO_REUSEPORT:
+            self.dhcp_socket.setsockopt(socket.SOL_SOCKET,
+                                        SO_REUSEPORT[platform], 1)
+
         self.BindToAddress()
 
+    def BindToAddress(self):
+        """
+            Overrides DhcpNetwork.BindToAddress(), which only prints an error
+            when binding fails and leaves us listening on nothing.
+        """
+        self.dhcp_socket.bind((self.listen_address, self.listen_port))
+
 
 class Server(DhcpServer):
     def __init__(self, options):
         DhcpServer.__init__(self,options["listen_address"],
                                  options["client_listen_port"],
                                  options["server_listen_port"])
+        self.filtered = False
+        self.counters = {'received': 0, 'bsdp': 0, 'dropped': 0}
+
+    def AttachBsdpFilter(self):
+        """
+            Attaches the program from compileBsdpFilter() to the socket so the
+            kernel drops all non-BSDP traffic to port 67 without waking us up.
+            Returns True on success; on failure nothing changes and every
+            packet keeps being received.
+        """
+        if not platform.startswith('linux'):
+            logging.debug('BPF socket filters are only supported on Linux')
+            return False
+
+        try:
+            program = ''.join([struct.pack('HBBI', *instruction)
+                               for instruction in compileBsdpFilter()])
+            programbuffer = ctypes.create_string_buffer(program)
+            # struct sock_fprog: the instruction count and a pointer to them
+            fprog = struct.pack('HL', len(program) / 8,
+                                ctypes.addressof(programbuffer))
+            self.dhcp_socket.setsockopt(socket.SOL_SOCKET, SO_ATTACH_FILTER,
+                                        fprog)
+        except (socket.error, ValueError):
+            logging.debug('Unable to attach BPF socket filter, receiving all '
+                          'packets: %s' % sys.exc_info()[1])
+            return False
+
+        self.filtered = True
+        logging.debug('Attached BPF socket filter for BSDP INFORM packets')
+        return True
+
+    def GetKernelDrops(self):
+        """
+            Returns the number of packets the kernel dropped for our socket,
+            from /proc/net/udp. With a BPF filter attached these are mostly the
+            packets it filtered out, the rest overflowed the receive buffer.
+        """
+        inode = os.fstat(self.dhcp_socket.fileno()).st_ino
+        try:
+            for line in open('/proc/net/udp').readlines()[1:]:
+                fields = line.split()
+                if int(fields[9]) == inode:
+                    return int(fields[12])
+        except (IOError, IndexError, ValueError):
+            pass
+        return None
+
+    def LogStatistics(self):
+        logging.debug('Packets received: %d, BSDP requests: %d, dropped for '
+                      'a full queue: %d, dropped by the kernel: %s '
+                      '(BPF filter %s)' %
+                      (self.counters['received'], self.counters['bsdp'],
+                       self.counters['dropped'], self.GetKernelDrops(),
+                       self.filtered and 'attached' or 'not attached'))
+
+    def GetNextDhcpPacket(self, timeout=60):
+        """
+            Overrides DhcpNetwork.GetNextDhcpPacket() to keep hold of the raw
+            packet data in packet.data, so BSDP packets can be written to a
+            capture file exactly as they were received.
+        """
+        data_input, data_output, data_except = \
+            select.select([self.dhcp_socket], [], [], timeout)
+        if data_input == []:
+            return None
+
+        data, source_address = self.dhcp_socket.recvfrom(2048)
+        if data == '':
+            return None
+        self.counters['received'] += 1
+
+        packet = DhcpPacket()
+        packet.source_address = source_address
+        packet.data = data
+        packet.DecodePacket(data)
+        return packet
 
     def HandleDhcpInform(self, packet):
         return packet
 
 
+class BsdpPacket(DhcpPacket):
+    """
+        The BsdpPacket class is a DhcpPacket that can encode options longer
+        than 255 bytes, by splitting them into consecutive instances of the same
+        option as RFC 3396 describes. Clients concatenate them again, which lets
+        an ACK[LIST] carry more images than fit in one vendor option.
+    """
+    def EncodePacket(self):
+        # Options MUST be in order of their codes, see DhcpBasicPacket
+        options = []
+        for code, name in sorted([(DhcpOptions[name], name)
+                                  for name in self.options_data.keys()]):
+            value = self.options_data[name]
+            for start in range(0, max(len(value), 1), 255):
+                chunk = value[start:start+255]
+                options += [code, len(chunk)] + chunk
+
+        packet = self.packet_data[:240] + options + [255]
+        return ''.join(map(chr, packet))
+
+
+class PacketCapture(object):
+    """
+        The PacketCapture class appends packets to a capture file, see
+        CAPTURERECORD for the format. readCapture() reads them back.
+    """
+    def __init__(self, path):
+        self.capturefile = open(path, 'wb')
+        self.capturefile.write(CAPTUREMAGIC + struct.pack('!I', CAPTUREVERSION))
+        self.lock = threading.Lock()
+
+    def write(self, data, address, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        ip, port = address
+        with self.lock:
+            self.capturefile.write(CAPTURERECORD.pack(timestamp,
+                                                      socket.inet_aton(ip),
+                                                      port, len(data)) + data)
+
+    def close(self):
+        self.capturefile.close()
+
+
+def readCapture(path):
+    """
+        The readCapture() function is a generator that yields the timestamp,
+        address and raw data of each packet in a capture file.
+    """
+    capturefile = open(path, 'rb')
+    try:
+        header = capturefile.read(len(CAPTUREMAGIC) + 4)
+        if header[:len(CAPTUREMAGIC)] != CAPTUREMAGIC:
+            raise ValueError('%s is not a BSDPy capture file' % path)
+        version = struct.unpack('!I', header[len(CAPTUREMAGIC):])[0]
+        if version != CAPTUREVERSION:
+            raise ValueError('Unsupported capture file version %d' % version)
+
+        while True:
+            record = capturefile.read(CAPTURERECORD.size)
+            if len(record) < CAPTURERECORD.size:
+                return
+            timestamp, ip, port, length = CAPTURERECORD.unpack(record)
+            yield timestamp, (socket.inet_ntoa(ip), port), \
+                capturefile.read(length)
+    finally:
+        capturefile.close()
+
+
 def find(pattern, path):
     """
         The find() function provides some basic file searching, used later
@@ -298,6 +663,7 @@ def getNbiOptions(incoming):
                 #   booter = The kernel which is loaded with tftp
                 #   disabledsysids = System IDs to blacklist, optional
                 #   dmg = The actual OS image loaded after the booter
+                #   dmgfile = Full local path to dmg, used for prewarming
                 #   enabledsysids = System IDs to whitelist, optional
                 #   enabledmacaddrs = Enabled MAC addresses to whitelist, optional
                 #                     (and for which a key may not exist in)
@@ -324,8 +690,9 @@ def getNbiOptions(incoming):
                 thisnbi['disabledsysids'] = \
                     nbimageinfo['DisabledSystemIdentifiers']
                 if nbimageinfo['Type'] != 'BootFileOnly':
+                    thisnbi['dmgfile'] = find('*.dmg', path)[0]
                     thisnbi['dmg'] = \
-                        '/'.join(find('*.dmg', path)[0].split('/')[2:])
+                        '/'.join(thisnbi['dmgfile'].split('/')[2:])
 
                 thisnbi['enabledmacaddrs'] = \
                     nbimageinfo.get('EnabledMACAddresses', [])
@@ -358,6 +725,209 @@ def getNbiOptions(incoming):
     return nbioptions, nbisources
 
 
+def adviseFile(fd, path, advice):
+    """
+        The adviseFile() function gives the kernel posix_fadvise() advice for
+        the whole of an open file. Returns False when fadvise is not available
+        (OS X, or a libc without it) or fails.
+    """
+    if hasattr(os, 'posix_fadvise'):
+        os.posix_fadvise(fd, 0, 0, advice)
+        return True
+    if libc is not None and hasattr(libc, 'posix_fadvise'):
+        # posix_fadvise() returns the error number instead of setting errno
+        result = libc.posix_fadvise(fd, ctypes.c_int64(0),
+                                    ctypes.c_int64(0), advice)
+        if result == 0:
+            return True
+        logging.debug('posix_fadvise failed for %s: %s'
+                        % (path, os.strerror(result)))
+    return False
+
+
+def prewarmFile(path):
+    """
+        The prewarmFile() function asks the kernel to pull a file into the page
+        cache using posix_fadvise(POSIX_FADV_WILLNEED), which on Linux starts
+        readahead of the whole file. When fadvise is not available the file is
+        read through once instead.
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        if adviseFile(fd, path, POSIX_FADV_WILLNEED):
+            return
+        while os.read(fd, 1024 * 1024):
+            pass
+    finally:
+        os.close(fd)
+
+
+def evictFile(path):
+    """
+        The evictFile() function asks the kernel to drop a file from the page
+        cache using posix_fadvise(POSIX_FADV_DONTNEED). Returns False when
+        fadvise is not available, in which case the pages are left for the
+        kernel to reclaim.
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        return adviseFile(fd, path, POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+
+class ImagePrewarmer(object):
+    """
+        The ImagePrewarmer class keeps the booter and DMG of the boot images
+        most likely to be selected in the page cache, so the first client to
+        pick an image does not pay for cold reads of a multi-GB DMG.
+
+        - Default images are prewarmed whenever the catalog is (re)scanned,
+          including those prewarmed before, whose pages the kernel may have
+          dropped since.
+        - Any other image is prewarmed on its first INFORM[SELECT].
+        - The total size of prewarmed images is kept under a budget. An image
+          that does not fit only replaces images that have been selected less
+          often than itself, so two images never keep pushing each other out
+          of the cache. Replaced images are dropped from the page cache with
+          posix_fadvise(POSIX_FADV_DONTNEED) where it is available; elsewhere
+          the budget only limits how much is prewarmed.
+
+        The actual reads are done by a single background thread so replies to
+        clients are never held up by disk I/O.
+    """
+    def __init__(self, budget, popularity):
+        self.budget = budget
+        self.used = 0
+        self.warmed = {}
+        self.popularity = popularity
+        self.lock = threading.Lock()
+        self.queue = Queue.Queue()
+
+        worker = threading.Thread(target=self.run)
+        worker.daemon = True
+        worker.start()
+
+    def imageFiles(self, image):
+        files = [image['booter']]
+        if 'dmgfile' in image:
+            files.append(image['dmgfile'])
+        return files
+
+    def imageSize(self, image):
+        size = 0
+        for path in self.imageFiles(image):
+            try:
+                size += os.path.getsize(path)
+            except OSError:
+                pass
+        return size
+
+    def rank(self, image):
+        return (image['isdefault'] is True,
+                self.popularity.get(image['id'], 0))
+
+    def admit(self, image):
+        """
+            Reserve budget for image, evicting less popular images if needed.
+            Must be called with self.lock held. Returns True if the image should
+            be prewarmed.
+        """
+        key = (image['id'], tuple(self.imageFiles(image)))
+        if key in self.warmed:
+            return False
+
+        size = self.imageSize(image)
+        if size > self.budget:
+            logging.debug('Image "%s" is larger than the prewarm budget, '
+                          'skipping' % image['name'])
+            return False
+
+        # Only images ranked strictly lower than this one can be evicted, and
+        #   the least popular ones go first
+        evictable = sorted([(self.rank(warm), k) for k, (warm, s) in
+                            self.warmed.items()
+                            if self.rank(warm) < self.rank(image)])
+        if self.used + size - sum([self.warmed[k][1] for r, k in evictable]) \
+           > self.budget:
+            return False
+
+        evicted = set()
+        while self.used + size > self.budget:
+            rank, victim = evictable.pop(0)
+            self.used -= self.warmed.pop(victim)[1]
+            evicted.update(victim[1])
+            logging.debug('Evicting image ID %s from prewarm budget' %
+                            victim[0])
+
+        self.warmed[key] = (image, size)
+        self.used += size
+
+        # Drop the files of evicted images from the page cache, unless they
+        #   are shared with an image that stays prewarmed
+        for k in self.warmed.keys():
+            evicted.difference_update(k[1])
+        for path in sorted(evicted):
+            self.queue.put(('evict', path))
+        return True
+
+    def scan(self, images):
+        """
+            Called with a freshly scanned catalog. Forgets images that are no
+            longer served and prewarms the defaults, followed by previously
+            selected images in order of popularity.
+        """
+        with self.lock:
+            current = set((image['id'], tuple(self.imageFiles(image)))
+                          for image in images)
+            for key in self.warmed.keys():
+                if key not in current:
+                    self.used -= self.warmed.pop(key)[1]
+
+            candidates = [image for image in images
+                          if image['isdefault'] is True or
+                          self.popularity.get(image['id'], 0) > 0]
+            candidates.sort(key=self.rank, reverse=True)
+            for image in candidates:
+                key = (image['id'], tuple(self.imageFiles(image)))
+                if key in self.warmed:
+                    # Prewarm defaults again in case the kernel dropped their
+                    #   pages, which is cheap if they are still cached
+                    if image['isdefault'] is True:
+                        self.queue.put(('warm', image))
+                elif self.admit(image):
+                    self.queue.put(('warm', image))
+
+    def select(self, image):
+        """
+            Called for every INFORM[SELECT] once it is counted in popularity,
+            prewarms the image if it is not cached yet.
+        """
+        with self.lock:
+            if self.admit(image):
+                self.queue.put(('warm', image))
+
+    def run(self):
+        while True:
+            action, item = self.queue.get()
+            if action == 'evict':
+                try:
+                    if evictFile(item):
+                        logging.debug('Dropped %s from the page cache' % item)
+                except (IOError, OSError):
+                    logging.debug('Unable to drop %s from the page cache: %s' %
+                                    (item, sys.exc_info()[1]))
+                continue
+
+            for path in self.imageFiles(item):
+                try:
+                    prewarmFile(path)
+                    logging.debug('Prewarmed ' + path)
+                except (IOError, OSError):
+                    logging.debug('Unable to prewarm %s: %s' %
+                                    (path, sys.exc_info()[1]))
+
+
 def getSysIdEntitlement(nbisources, clientsysid, clientmacaddr, bsdpmsgtype):
     """
         The getSysIdEntitlement function takes a list of previously compiled NBI
@@ -389,17 +959,9 @@ def getSysIdEntitlement(nbisources, clientsysid, clientmacaddr, bsdpmsgtype):
             - If both are True thisnbi is added to nbientitlements.
     """
 
-    # Globals are used to give other functions access to these later
-    global defaultnbi
-    global imagenameslist
-    global hasdefault
-
     logging.debug('Determining image list for system ID ' + clientsysid)
 
-    # Initialize lists for nbientitlements and imagenameslist, both will
-    #   contain a series of dicts
     nbientitlements = []
-    imagenameslist = []
 
     try:
         # Iterate over the NBI list
@@ -453,37 +1015,20 @@ def getSysIdEntitlement(nbisources, clientsysid, clientmacaddr, bsdpmsgtype):
                         sys.exc_info()[1])
         raise
 
-    try:
-        # Now we iterate through the entitled NBIs in search of a default
-        #   image, as determined by its "IsDefault" key
-        for image in nbientitlements:
+    # All done, pass the finalized list of NBIs the given clientsysid back
+    return nbientitlements
+
 
-            # Check for an isdefault entry in the current NBI
-            if image['isdefault'] is True:
-                logging.debug('Found default image ID ' + str(image['id']))
-
-                # By default defaultnbi is 0, so change it to the matched NBI's
-                #   id. If more than one is found (shouldn't) we use the highest
-                #   id found. This behavior may be changed if it proves to be
-                #   problematic, such as breaking out of the for loop instead.
-                if defaultnbi < image['id']:
-                    defaultnbi = image['id']
-                    hasdefault = True
-                    # logging.debug('Setting default image ID ' + str(defaultnbi))
-                    # logging.debug('hasdefault is: ' + str(hasdefault))
-
-            # This is to match cases where there is  no default image found,
-            #   a possibility. In that case we use the highest found id as the
-            #   default. This too could be changed at a later time.
-            elif not hasdefault:
-                if defaultnbi < image['id']:
-                    defaultnbi = image['id']
-                    # logging.debug('Changing default image ID ' + str(defaultnbi))
-
-            # Next we construct our imagenameslist which is a list of ints that
-            #   encodes the image id, total name length and its name for use
-            #   by the packet encoder
+def encodeImageList(nbientitlements):
+    """
+        The encodeImageList() function constructs the imagenameslist for a
+        list of entitled NBIs, a list of ints that encodes each image's id,
+        name length and name for use by the packet encoder.
+    """
+    imagenameslist = []
 
+    try:
+        for image in nbientitlements:
             # The imageid should be a zero-padded 4 byte string represented as
             #   ints
             imageid = '%04X' % image['id']
@@ -499,15 +1044,292 @@ def getSysIdEntitlement(nbisources, clientsysid, clientmacaddr, bsdpmsgtype):
             imagenameslist += [129,0] + imageid + [image['length']] + \
                               strlist(image['name']).list()
     except:
-        logging.debug("Unexpected error setting default image: %s" %
+        logging.debug("Unexpected error encoding image list: %s" %
                         sys.exc_info()[1])
         raise
 
-    # print 'Entitlements: ' + str(len(nbientitlements)) + '\n' + str(nbientitlements) + '\n'
-    # print imagenameslist
+    return imagenameslist
 
-    # All done, pass the finalized list of NBIs the given clientsysid back
-    return nbientitlements
+
+def compileEntitlementIndex(nbisources):
+    """
+        The compileEntitlementIndex() function turns a list of NBIs into an
+        index of bitmasks, one bit per NBI in list order, so the entitlements
+        of many clients can be evaluated without walking every NBI for each of
+        them. See evaluateEntitlement() for how the masks are combined.
+
+        - all: a mask with the bit of every NBI set
+        - disabledsysids: maps each system ID to the NBIs that disable it
+        - macrestricted: the NBIs that have an EnabledMACAddresses list
+        - enabledmacaddrs: maps each MAC address to the NBIs that enable it
+    """
+    index = {'images': list(nbisources),
+             'all': (1 << len(nbisources)) - 1,
+             'disabledsysids': {},
+             'macrestricted': 0,
+             'enabledmacaddrs': {}}
+
+    for position, thisnbi in enumerate(nbisources):
+        bit = 1 << position
+        for sysid in thisnbi['disabledsysids']:
+            index['disabledsysids'][sysid] = \
+                index['disabledsysids'].get(sysid, 0) | bit
+        if thisnbi['enabledmacaddrs']:
+            index['macrestricted'] |= bit
+            for macaddr in thisnbi['enabledmacaddrs']:
+                index['enabledmacaddrs'][macaddr] = \
+                    index['enabledmacaddrs'].get(macaddr, 0) | bit
+
+    return index
+
+
+def evaluateEntitlement(index, clientsysid, clientmacaddr):
+    """
+        The evaluateEntitlement() function returns the list of NBIs in a
+        compiled index the client is entitled to, with the same outcome as
+        getSysIdEntitlement(): an NBI is skipped when it disables the client's
+        system ID (which includes duplicate entries) or when it has a MAC
+        address whitelist without the client's MAC address in it.
+    """
+    mask = index['all'] & ~index['disabledsysids'].get(clientsysid, 0)
+    mask &= ~index['macrestricted'] | \
+        index['enabledmacaddrs'].get(clientmacaddr, 0)
+
+    return [image for position, image in enumerate(index['images'])
+            if mask >> position & 1]
+
+
+def defaultImageId(nbientitlements):
+    """
+        The defaultImageId() function picks the default image ID out of a list
+        of entitled NBIs: the highest ID marked IsDefault, or if there is none
+        the highest ID overall. Returns 0 when the list is empty.
+    """
+    defaults = [image['id'] for image in nbientitlements
+                if image['isdefault'] is True]
+    if defaults:
+        return max(defaults)
+    return max([image['id'] for image in nbientitlements] or [0])
+
+
+def publishCatalog(nbiimages, path):
+    """
+        The publishCatalog() function compiles a list of NBIs and their
+        entitlement index into a read-only catalog file that any number of
+        server processes can map into memory with MappedCatalog, instead of
+        each of them parsing every NBImageInfo.plist.
+
+        The file is written next to path and renamed over it, so readers see
+        either the old or the new catalog, never a partial one. Every publish
+        bumps the generation of the catalog it replaces. Returns the new
+        generation.
+    """
+    index = compileEntitlementIndex(nbiimages)
+    masklength = (len(nbiimages) + 7) / 8
+
+    try:
+        generation = readCatalogGeneration(path) + 1
+    except (IOError, ValueError, struct.error):
+        generation = 1
+
+    # The tables are sorted by their encoded keys, which is what
+    #   MappedCatalog.lookup() compares
+    def encodeKeys(table):
+        return sorted([(key.encode('utf-8'), bits)
+                       for key, bits in table.items()])
+
+    sysids = encodeKeys(index['disabledsysids'])
+    macaddrs = encodeKeys(index['enabledmacaddrs'])
+
+    imagesoffset = CATALOGHEADER.size
+    sysidsoffset = imagesoffset + len(nbiimages) * CATALOGIMAGE.size
+    macsoffset = sysidsoffset + len(sysids) * CATALOGKEY.size
+    pool = []
+    pooloffset = [macsoffset + len(macaddrs) * CATALOGKEY.size]
+
+    def store(data):
+        offset = pooloffset[0]
+        pool.append(data)
+        pooloffset[0] += len(data)
+        return offset
+
+    def storeMask(bits):
+        if masklength == 0:
+            return store('')
+        return store(('%0*x' % (masklength * 2, bits)).decode('hex'))
+
+    def storeText(value):
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        return store(value), len(value)
+
+    records = []
+    for image in nbiimages:
+        fields = []
+        for field in CATALOGFIELDS:
+            if field in image:
+                fields += storeText(image[field])
+            else:
+                fields += [CATALOGNOFIELD, 0]
+        records.append(CATALOGIMAGE.pack(image['id'],
+                                         image['isdefault'] is True, *fields))
+
+    for table in [sysids, macaddrs]:
+        for key, bits in table:
+            keyoffset, keylength = storeText(key)
+            records.append(CATALOGKEY.pack(keyoffset, keylength,
+                                           storeMask(bits)))
+
+    macrestrictedoffset = storeMask(index['macrestricted'])
+
+    header = CATALOGHEADER.pack(CATALOGMAGIC, CATALOGVERSION, generation,
+                                len(nbiimages), masklength,
+                                macrestrictedoffset, imagesoffset,
+                                sysidsoffset, len(sysids), macsoffset,
+                                len(macaddrs))
+
+    temppath = '%s.%d.tmp' % (path, os.getpid())
+    catalogfile = open(temppath, 'wb')
+    try:
+        catalogfile.write(header + ''.join(records) + ''.join(pool))
+        catalogfile.flush()
+        os.fsync(catalogfile.fileno())
+    finally:
+        catalogfile.close()
+    os.chmod(temppath, 0644)
+    os.rename(temppath, path)
+
+    logging.debug('Published catalog generation %d with %d images to %s' %
+                    (generation, len(nbiimages), path))
+    return generation
+
+
+def readCatalogGeneration(path):
+    """
+        The readCatalogGeneration() function returns the generation of the
+        catalog at path from its header, without reading the rest of it.
+    """
+    catalogfile = open(path, 'rb')
+    try:
+        header = catalogfile.read(CATALOGHEADER.size)
+    finally:
+        catalogfile.close()
+
+    magic, version, generation = CATALOGHEADER.unpack(header)[:3]
+    if magic != CATALOGMAGIC or version != CATALOGVERSION:
+        raise ValueError('%s is not a version %d BSDPy catalog' %
+                            (path, CATALOGVERSION))
+    return generation
+
+
+class MappedCatalog(object):
+    """
+        The MappedCatalog class serves the NBIs and entitlements of a catalog
+        file written by publishCatalog(). The file is mapped read-only, so the
+        processes serving one host share a single copy through the page cache.
+        The image records are decoded once, when the catalog is mapped, and
+        entitlements are looked up in the compiled index in place.
+
+        Since catalogs are published by renaming a new file over the old one,
+        a mapping never changes under its readers. isStale() tells when
+        another catalog has been published at the same path.
+    """
+    def __init__(self, path):
+        self.path = path
+        catalogfile = open(path, 'rb')
+        try:
+            self.stat = os.fstat(catalogfile.fileno())
+            self.data = mmap.mmap(catalogfile.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+        finally:
+            catalogfile.close()
+
+        (magic, version, self.generation, self.imagecount, self.masklength,
+         self.macrestrictedoffset, self.imagesoffset, self.sysidsoffset,
+         self.sysidcount, self.macsoffset, self.maccount) = \
+            CATALOGHEADER.unpack_from(self.data, 0)
+
+        if magic != CATALOGMAGIC or version != CATALOGVERSION:
+            raise ValueError('%s is not a version %d BSDPy catalog' %
+                                (path, CATALOGVERSION))
+
+        self.images = [self.image(position)
+                       for position in range(self.imagecount)]
+
+    def isStale(self):
+        """
+            Returns True if the catalog at our path has another generation,
+            which is read from its header only, or is another file. The file
+            identity catches a catalog that was deleted and published again,
+            which starts over at generation 1. Our mapping keeps the inode of
+            the old file in use, so a new file never gets the same one.
+        """
+        try:
+            stat = os.stat(self.path)
+            if (stat.st_dev, stat.st_ino) != \
+               (self.stat.st_dev, self.stat.st_ino):
+                return True
+            return readCatalogGeneration(self.path) != self.generation
+        except (IOError, OSError, ValueError, struct.error):
+            return False
+
+    def mask(self, offset):
+        if self.masklength == 0:
+            return 0
+        return int(self.data[offset:offset + self.masklength].encode('hex'),
+                   16)
+
+    def lookup(self, tableoffset, count, key):
+        """
+            Returns the bitmask of key in a sorted CATALOGKEY table, or 0.
+        """
+        low, high = 0, count
+        while low < high:
+            middle = (low + high) / 2
+            keyoffset, keylength, maskoffset = \
+                CATALOGKEY.unpack_from(self.data,
+                                       tableoffset + middle * CATALOGKEY.size)
+            entry = self.data[keyoffset:keyoffset + keylength]
+            if entry == key:
+                return self.mask(maskoffset)
+            elif entry < key:
+                low = middle + 1
+            else:
+                high = middle
+        return 0
+
+    def image(self, position):
+        """
+            Decodes the NBI at position into a dict like getNbiOptions()
+            returns, without the system ID and MAC address lists, which are
+            only kept in the compiled index. Only used when mapping, requests
+            are answered from the decoded images.
+        """
+        record = CATALOGIMAGE.unpack_from(self.data,
+            self.imagesoffset + position * CATALOGIMAGE.size)
+        thisnbi = {'id': record[0], 'isdefault': record[1] == 1}
+        for i, field in enumerate(CATALOGFIELDS):
+            offset, length = record[2 + 2 * i:4 + 2 * i]
+            if offset != CATALOGNOFIELD:
+                thisnbi[field] = self.data[offset:offset + length]
+        thisnbi['length'] = len(thisnbi['name'])
+        return thisnbi
+
+    def entitlements(self, clientsysid, clientmacaddr):
+        """
+            Returns the NBIs the client is entitled to, the same way
+            evaluateEntitlement() does for an in-memory index.
+        """
+        logging.debug('Determining image list for system ID %s from catalog '
+                      'generation %d' % (clientsysid, self.generation))
+
+        mask = ((1 << self.imagecount) - 1) & \
+            ~self.lookup(self.sysidsoffset, self.sysidcount, clientsysid)
+        mask &= ~self.mask(self.macrestrictedoffset) | \
+            self.lookup(self.macsoffset, self.maccount, clientmacaddr)
+
+        return [image for position, image in enumerate(self.images)
+                if mask >> position & 1]
 
 
 def parseOptions(bsdpoptions):
@@ -547,303 +1369,929 @@ def parseOptions(bsdpoptions):
     return optionvalues
 
 
-def ack(packet, defaultnbi, msgtype):
+class BsdpEngine(object):
     """
-        The ack function constructs either a BSDP[LIST] or BSDP[SELECT] ACK
-        DhcpPacket(), determined by the given msgtype, 'list' or 'select'.
-        It calls the previously defined getSysIdEntitlement() and parseOptions()
-        functions for either msgtype.
+        The BsdpEngine class answers BSDP requests from a snapshot of the NBI
+        catalog and the server settings it was created with, which never
+        change after it is created. The only state it keeps between requests
+        is listcache, a cache of encoded image lists that every thread reads
+        and writes with single dict operations, so a single engine can be
+        shared by any number of threads. When the catalog is rescanned a new
+        engine is created with withCatalog().
+
+        The catalog is either a list of NBIs as returned by getNbiOptions() or
+        a MappedCatalog, whose compiled entitlement index is used instead.
+
+        The optional onselect callable is called with the NBI of every
+        INFORM[SELECT] that is answered, so the caller can keep statistics.
+        The optional popularity dict maps image IDs to how often they were
+        selected, and is only read to order image lists. Whoever updates it
+        from several threads has to serialize the updates.
     """
+    def __init__(self, nbiimages, serverip_str, bootproto, tftprootpath,
+                 nbiurl=None, onselect=None, popularity=None):
+        if isinstance(nbiimages, MappedCatalog):
+            self.catalog = nbiimages
+        else:
+            self.catalog = None
+            self.nbiimages = tuple(nbiimages)
+        self.serverip_str = serverip_str
+        self.serverip = map(int, serverip_str.split('.'))
+        self.serverhostname = serverip_str
+        self.bootproto = bootproto
+        self.tftprootpath = tftprootpath
+        self.nbiurl = nbiurl
+        self.onselect = onselect
+        if popularity is None:
+            popularity = {}
+        self.popularity = popularity
+        self.listcache = {}
+        self.basedmgpath = getBaseDmgPath(bootproto, serverip_str,
+                                          tftprootpath, nbiurl)
+
+    def withCatalog(self, nbiimages):
+        """
+            Returns a new engine with the same settings serving nbiimages.
+        """
+        return BsdpEngine(nbiimages, self.serverip_str, self.bootproto,
+                          self.tftprootpath, self.nbiurl, self.onselect,
+                          self.popularity)
+
+    def maxReplySize(self, packet, bsdpoptions):
+        """
+            Returns the largest reply the client accepts, from the BSDP
+            max_message_size option and the DHCP maximum_dhcp_message_size
+            option. Both count the IP and UDP headers, which are subtracted.
+            Clients that advertise neither get the 576 bytes every DHCP client
+            must accept.
+        """
+        sizes = []
+        for size in [bsdpoptions.get('max_message_size'),
+                     packet.GetOption('maximum_dhcp_message_size')]:
+            if size and len(size) == 2:
+                sizes.append(size[0] << 8 | size[1])
+
+        return max(min(sizes or [DHCPMINMESSAGESIZE]), DHCPMINMESSAGESIZE) - 28
+
+    def encodeListOptions(self, enablednbis, defaultid, maxsize):
+        """
+            The encodeListOptions() method builds the vendor_encapsulated_options
+            of an ACK[LIST] reply of at most maxsize bytes:
+            - [1,1,1] = BSDP message type (1), length (1), value (1 = list)
+            - [4,2,128,128] = Server priority message type 4, length 2,
+                value 0x8080
+            - defaultid (option 7) - Optional, not sent if 0
+            - List of the available Image IDs and names (option 9). A single
+                option holds at most 255 bytes, so larger lists are spread over
+                several option 9 instances, each holding whole images. Images
+                with names too long to fit in one option are left out.
+
+            Images are listed default image first, then by how often they have
+            been selected, so the most relevant ones survive when not all of
+            them fit. Encodings are cached by image order and reply size.
+        """
+        order = sorted(range(len(enablednbis)), key=lambda i:
+                       (enablednbis[i]['id'] != defaultid,
+                        -self.popularity.get(enablednbis[i]['id'], 0), i))
+        images = [enablednbis[i] for i in order]
+
+        key = (tuple([image['id'] for image in images]), defaultid, maxsize)
+        compiledlistpacket = self.listcache.get(key)
+        if compiledlistpacket is not None:
+            return compiledlistpacket
+
+        compiledlistpacket = [1,1,1,4,2,128,128]
+        if defaultid != 0:
+            compiledlistpacket += [7,4,129,0,defaultid >> 8,defaultid & 0xff]
+
+        # The reply carries the DHCP header and magic cookie (240 bytes), the
+        #   dhcp_message_type (3), server_identifier (6) and
+        #   vendor_class_identifier (11) options and the end option (1). The
+        #   rest is for vendor_encapsulated_options, which takes 2 bytes of
+        #   option header for every 255 bytes of data, see BsdpPacket.
+        room = maxsize - 261
+
+        bsdpimagelist = []
+        imagelist = []
+        listed = 0
+        for image in images:
+            entry = encodeImageList([image])
+            if len(entry) > 255:
+                logging.debug('Image "%s" has a name too long for an image '
+                              'list, skipping' % image['name'])
+                continue
+            if len(imagelist) + len(entry) > 255:
+                bsdpimagelist += [9, len(imagelist)] + imagelist
+                imagelist = []
+
+            length = len(compiledlistpacket) + len(bsdpimagelist) + \
+                     2 + len(imagelist) + len(entry)
+            if length + 2 * ((length + 254) / 255) > room:
+                logging.debug('Image list truncated to %d of %d images to '
+                              'fit a %d byte reply' %
+                              (listed, len(images), maxsize))
+                break
+
+            imagelist += entry
+            listed += 1
+
+        if imagelist:
+            bsdpimagelist += [9, len(imagelist)] + imagelist
+        compiledlistpacket += bsdpimagelist
+
+        # Keep the cache from growing without bounds as popularity changes
+        if len(self.listcache) >= 1024:
+            self.listcache.clear()
+        self.listcache[key] = compiledlistpacket
+        return compiledlistpacket
+
+    def handle(self, packet):
+        """
+            The handle() method looks at the vendor_encapsulated_options of a
+            received packet and passes BSDP INFORM[LIST] and INFORM[SELECT]
+            requests on to ack(). It returns the ACK packet along with the
+            client IP and port to send it to, or None if the packet needs no
+            reply.
+        """
+        bsdpoptions = packet.GetOption('vendor_encapsulated_options')
+
+        # If the packet length is 2 or less, move on, BSDP packets are at least
+        #   8 bytes long.
+        if len(bsdpoptions) <= 2:
+            return None
+
+        # If we have vendor_encapsulated_options check for a value of 1 which
+        #   in BSDP terms means the packet is a BSDP[LIST] request
+        if bsdpoptions[2] == 1:
+            logging.debug('-=========================================-')
+            logging.debug('Got BSDP INFORM[LIST] packet: ')
 
-    bsdpack = DhcpPacket()
+            return self.ack(packet, 'list')
 
-    try:
-        # Get the requesting client's clientsysid and MAC address from the
-        # BSDP options
-        clientsysid = \
-        str(strlist(packet.GetOption('vendor_class_identifier'))).split('/')[2]
-
-        clientmacaddr = chaddr_to_mac(packet.GetOption('chaddr'))
-
-        # Decode and parse the BSDP options from vendor_encapsulated_options
-        bsdpoptions = \
-            parseOptions(packet.GetOption('vendor_encapsulated_options'))
-
-        # Figure out the NBIs this clientsysid is entitled to
-        enablednbis = getSysIdEntitlement(nbiimages, clientsysid, clientmacaddr, msgtype)
-
-        # The Startup Disk preference panel in OS X uses a randomized reply port
-        #   instead of the standard port 68. We check for the existence of that
-        #   option in the bsdpoptions dict and if found set replyport to it.
-        if 'reply_port' in bsdpoptions:
-            replyport = int(str(format(bsdpoptions['reply_port'][0], 'x') +
-                        format(bsdpoptions['reply_port'][1], 'x')), 16)
-        else:
-            replyport = 68
+        # If the vendor_encapsulated_options BSDP type is 2, we process the
+        #   packet as a BSDP[SELECT] request
+        elif bsdpoptions[2] == 2:
+            logging.debug('-=========================================-')
+            logging.debug('Got BSDP INFORM[SELECT] packet: ')
 
-        # Get the client's IP address, a standard DHCP option
-        clientip = ipv4(packet.GetOption('ciaddr'))
-        if str(clientip) == '0.0.0.0':
-            clientip = ipv4(packet.GetOption('request_ip_address'))
-            logging.debug("Did not get a valid clientip, using request_ip_address %s instead" % (str(clientip),))
-    except:
-        logging.debug("Unexpected error: ack() common %s" %
-                        sys.exc_info()[1])
-        raise
+            return self.ack(packet, 'select')
+
+        return None
+
+    def ack(self, packet, msgtype):
+        """
+            The ack method constructs either a BSDP[LIST] or BSDP[SELECT] ACK
+            DhcpPacket(), determined by the given msgtype, 'list' or 'select'.
+            It calls the previously defined getSysIdEntitlement() and
+            parseOptions() functions for either msgtype.
+        """
+
+        bsdpack = BsdpPacket()
 
-    #print 'Configuring common BSDP packet options'
-
-    # We construct the rest of our common BSDP reply parameters according to
-    #   Apple's spec. The only noteworthy parameter here is sname, a zero-padded
-    #   64 byte string list containing the BSDP server's hostname.
-    bsdpack.SetOption("op", [2])
-    bsdpack.SetOption("htype", packet.GetOption('htype'))
-    bsdpack.SetOption("hlen", packet.GetOption('hlen'))
-    bsdpack.SetOption("xid", packet.GetOption('xid'))
-    bsdpack.SetOption("ciaddr", packet.GetOption('ciaddr'))
-    bsdpack.SetOption("siaddr", serverip)
-    bsdpack.SetOption("yiaddr", [0,0,0,0])
-    bsdpack.SetOption("sname", strlist(serverhostname.ljust(64,'\x00')).list())
-    bsdpack.SetOption("chaddr", packet.GetOption('chaddr'))
-    bsdpack.SetOption("dhcp_message_type", [5])
-    bsdpack.SetOption("server_identifier", serverip)
-    bsdpack.SetOption("vendor_class_identifier", strlist('AAPLBSDPC').list())
-
-    # Process BSDP[LIST] requests
-    if msgtype == 'list':
-        #print 'Creating LIST packet'
         try:
-            nameslength = 0
-            n = 2
+            # Get the requesting client's clientsysid and MAC address from the
+            # BSDP options
+            clientsysid = \
+            str(strlist(packet.GetOption('vendor_class_identifier'))).split('/')[2]
+
+            clientmacaddr = chaddr_to_mac(packet.GetOption('chaddr'))
 
-            # First calculate the total length of the names of all combined
-            #   NBIs, a required parameter that is part of the BSDP
-            #   vendor_encapsulated_options.
-            for i in enablednbis:
-                nameslength += i['length']
-
-            # Next calculate the total length of all enabled NBIs
-            totallength = len(enablednbis) * 5 + nameslength
-
-            # The bsdpimagelist var is inserted into vendor_encapsulated_options
-            #   and comprises of the option code (9), total length of options,
-            #   the IDs and names of all NBIs and the 4 byte string list that
-            #   contains the default NBI ID. Promise, all of this is part of
-            #   the BSDP spec, go look it up.
-            bsdpimagelist = [9,totallength]
-            bsdpimagelist += imagenameslist
-            defaultnbi = '%04X' % defaultnbi
-
-            # Encode the default NBI option (7) its standard length (4) and the
-            #   16 bit string list representation of defaultnbi
-            defaultnbi = [7,4,129,0] + \
-            [int(defaultnbi[i:i+n], 16) for i in range(0, len(defaultnbi), n)]
-
-            if int(defaultnbi[-1:][0]) == 0:
-                hasnulldefault = True
+            # Decode and parse the BSDP options from vendor_encapsulated_options
+            bsdpoptions = \
+                parseOptions(packet.GetOption('vendor_encapsulated_options'))
+
+            # Figure out the NBIs this clientsysid is entitled to
+            if self.catalog is not None:
+                enablednbis = self.catalog.entitlements(clientsysid,
+                                                        clientmacaddr)
             else:
-                hasnulldefault = False
-
-            # To prevent sending a default image ID of 0 (zero) to the client
-            #   after the initial INFORM[LIST] request we test for 0 and if
-            #   so, skip inserting the defaultnbi BSDP option. Since it is
-            #   optional anyway we won't confuse the client.
-            compiledlistpacket = strlist([1,1,1,4,2,128,128]).list()
-            if not hasnulldefault:
-                compiledlistpacket += strlist(defaultnbi).list()
-            compiledlistpacket += strlist(bsdpimagelist).list()
-
-            # And finally, once we have all the image list encoding taken care
-            #   of, we plug them into the vendor_encapsulated_options DHCP
-            #   option after the option header:
-            #   - [1,1,1] = BSDP message type (1), length (1), value (1 = list)
-            #   - [4,2,255,255] = Server priority message type 4, length 2,
-            #       value 0xffff (65535 - Highest)
-            #   - defaultnbi (option 7) - Optional, not sent if '0'
-            #   - List of all available Image IDs (option 9)
-
-            bsdpack.SetOption("vendor_encapsulated_options", compiledlistpacket)
-
-            # Some debugging to stdout
-            logging.debug('-=========================================-')
-            logging.debug("Return ACK[LIST] to " +
-                    str(clientip) +
-                    ' on ' +
-                    str(replyport))
-            if hasnulldefault is False: logging.debug("Default boot image ID: " +
-                                              str(defaultnbi[2:]))
-        except:
-            logging.debug("Unexpected error ack() list: %s" %
-                            sys.exc_info()[1])
-            raise
+                enablednbis = getSysIdEntitlement(self.nbiimages, clientsysid,
+                                                  clientmacaddr, msgtype)
+
+            # The Startup Disk preference panel in OS X uses a randomized reply port
+            #   instead of the standard port 68. We check for the existence of that
+            #   option in the bsdpoptions dict and if found set replyport to it.
+            if 'reply_port' in bsdpoptions:
+                replyport = int(str(format(bsdpoptions['reply_port'][0], 'x') +
+                            format(bsdpoptions['reply_port'][1], 'x')), 16)
+            else:
+                replyport = 68
 
-    # Process BSDP[SELECT] requests
-    elif msgtype == 'select':
-        #print 'Creating SELECT packet'
-        # Get the value of selected_boot_image as sent by the client and convert
-        #   the value for later use.
-        try:
-            imageid = int('%02X' % bsdpoptions['selected_boot_image'][2] +
-                            '%02X' % bsdpoptions['selected_boot_image'][3], 16)
+            # Get the client's IP address, a standard DHCP option
+            clientip = ipv4(packet.GetOption('ciaddr'))
+            if str(clientip) == '0.0.0.0':
+                clientip = ipv4(packet.GetOption('request_ip_address'))
+                logging.debug("Did not get a valid clientip, using request_ip_address %s instead" % (str(clientip),))
         except:
-            logging.debug("Unexpected error ack() select: imageid %s" %
+            logging.debug("Unexpected error: ack() common %s" %
                             sys.exc_info()[1])
             raise
 
-        # Initialize variables for the booter file (kernel) and the dmg path
-        booterfile = ''
-        rootpath = ''
-        selectedimage = ''
-        if nbiurl.hostname[0].isalpha():
-            basedmgpath = getBaseDmgPath(nbiurl)
+        #print 'Configuring common BSDP packet options'
+
+        # We construct the rest of our common BSDP reply parameters according to
+        #   Apple's spec. The only noteworthy parameter here is sname, a zero-padded
+        #   64 byte string list containing the BSDP server's hostname.
+        bsdpack.SetOption("op", [2])
+        bsdpack.SetOption("htype", packet.GetOption('htype'))
+        bsdpack.SetOption("hlen", packet.GetOption('hlen'))
+        bsdpack.SetOption("xid", packet.GetOption('xid'))
+        bsdpack.SetOption("ciaddr", packet.GetOption('ciaddr'))
+        bsdpack.SetOption("siaddr", self.serverip)
+        bsdpack.SetOption("yiaddr", [0,0,0,0])
+        bsdpack.SetOption("sname", strlist(self.serverhostname.ljust(64,'\x00')).list())
+        bsdpack.SetOption("chaddr", packet.GetOption('chaddr'))
+        bsdpack.SetOption("dhcp_message_type", [5])
+        bsdpack.SetOption("server_identifier", self.serverip)
+        bsdpack.SetOption("vendor_class_identifier", strlist('AAPLBSDPC').list())
+
+        # Process BSDP[LIST] requests
+        if msgtype == 'list':
+            #print 'Creating LIST packet'
+            try:
+                defaultid = defaultImageId(enablednbis)
+                compiledlistpacket = self.encodeListOptions(enablednbis,
+                    defaultid, self.maxReplySize(packet, bsdpoptions))
+                bsdpack.SetOption("vendor_encapsulated_options", compiledlistpacket)
+
+                # Some debugging to stdout
+                logging.debug('-=========================================-')
+                logging.debug("Return ACK[LIST] to " +
+                        str(clientip) +
+                        ' on ' +
+                        str(replyport))
+                if defaultid != 0: logging.debug("Default boot image ID: " +
+                                                 str(defaultid))
+            except:
+                logging.debug("Unexpected error ack() list: %s" %
+                                sys.exc_info()[1])
+                raise
+
+        # Process BSDP[SELECT] requests
+        elif msgtype == 'select':
+            #print 'Creating SELECT packet'
+            # Get the value of selected_boot_image as sent by the client and convert
+            #   the value for later use.
+            try:
+                imageid = int('%02X' % bsdpoptions['selected_boot_image'][2] +
+                                '%02X' % bsdpoptions['selected_boot_image'][3], 16)
+            except:
+                logging.debug("Unexpected error ack() select: imageid %s" %
+                                sys.exc_info()[1])
+                raise
+
+            # Initialize variables for the booter file (kernel) and the dmg path
+            booterfile = ''
+            rootpath = ''
+            selectedimage = ''
+            if self.nbiurl is not None and self.nbiurl.hostname[0].isalpha():
+                logging.debug('Refreshing basedmgpath because '
+                              'DOCKER_BSDPY_NBI_URL uses hostname, not IP')
+                basedmgpath = getBaseDmgPath(self.bootproto, self.serverip_str,
+                                             self.tftprootpath, self.nbiurl)
+            else:
+                basedmgpath = self.basedmgpath
+
+            # Iterate over enablednbis and retrieve the kernel and boot DMG for each
+            try:
+                for nbidict in enablednbis:
+                    if nbidict['id'] == imageid:
+                        booterfile = nbidict['booter']
+                        rootpath = basedmgpath + nbidict['dmg']
+                        # logging.debug('-->> Using boot image URI: ' + str(rootpath))
+                        selectedimage = bsdpoptions['selected_boot_image']
+                        # logging.debug('ACK[SELECT] image ID: ' + str(selectedimage))
+                        if self.onselect is not None:
+                            self.onselect(nbidict)
+            except:
+                logging.debug("Unexpected error ack() selectedimage: %s" %
+                                sys.exc_info()[1])
+                raise
+
+            # Generate the rest of the BSDP[SELECT] ACK packet by encoding the
+            #   name of the kernel (file), the TFTP path and the vendor encapsulated
+            #   options:
+            #   - [1,1,2] = BSDP message type (1), length (1), value (2 = select)
+            #   - [8,4] = BSDP selected_image (8), length (4), encoded image ID
+            try:
+                bsdpack.SetOption("file",
+                    strlist(booterfile.ljust(128,'\x00')).list())
+                bsdpack.SetOption("root_path", strlist(rootpath).list())
+                bsdpack.SetOption("vendor_encapsulated_options",
+                    strlist([1,1,2,8,4] + selectedimage).list())
+            except:
+                logging.debug("Unexpected error ack() select SetOption: %s" %
+                                sys.exc_info()[1])
+                raise
 
-        # Iterate over enablednbis and retrieve the kernel and boot DMG for each
+            try:
+                # Some debugging to stdout
+                logging.debug('-=========================================-')
+                logging.debug("Return ACK[SELECT] to " +
+                              str(clientip) +
+                              ' on ' +
+                              str(replyport))
+                logging.debug("--> TFTP path: %s\n-->Boot image URI: %s"
+                              % (str(strlist(bsdpack.GetOption("file"))), str(rootpath)))
+            except:
+                logging.debug("Unexpected error ack() select print debug: %s" %
+                                sys.exc_info()[1])
+                raise
+
+        # Return the finished packet, client IP and reply port back to the caller
+        return bsdpack, clientip, replyport
+
+
+def replay(engine, capturepath, speed, recordpath=None, goldenpath=None):
+    """
+        The replay() function feeds the packets of a capture file through
+        a BsdpEngine, optionally at (a multiple of) the speed they were
+        originally received at, and reports the throughput of the reply engine.
+
+        Each request gets exactly one record in the recordpath capture: the
+        encoded reply and the address it would have been sent to, or an empty
+        record if there was no reply. This keeps a recording aligned with its
+        requests, so it can be used as the golden capture of a later replay.
+    """
+    record = None
+    if recordpath:
+        record = PacketCapture(recordpath)
+
+    replies = []
+    requests = 0
+    errors = 0
+    elapsed = 0.0
+    firststamp = None
+    started = time.time()
+
+    for timestamp, address, data in readCapture(capturepath):
+        requests += 1
+
+        # Wait until the packet is due when replaying at the original timing
+        if firststamp is None:
+            firststamp = timestamp
+        if speed > 0:
+            delay = (timestamp - firststamp) / speed - \
+                    (time.time() - started)
+            if delay > 0:
+                time.sleep(delay)
+
+        begin = time.time()
         try:
-            for nbidict in enablednbis:
-                if nbidict['id'] == imageid:
-                    booterfile = nbidict['booter']
-                    rootpath = basedmgpath + nbidict['dmg']
-                    # logging.debug('-->> Using boot image URI: ' + str(rootpath))
-                    selectedimage = bsdpoptions['selected_boot_image']
-                    # logging.debug('ACK[SELECT] image ID: ' + str(selectedimage))
+            packet = DhcpPacket()
+            packet.source_address = address
+            packet.DecodePacket(data)
+            reply = engine.handle(packet)
+            if reply is not None:
+                bsdpack, clientip, replyport = reply
+                reply = (bsdpack.EncodePacket(), (str(clientip), replyport))
         except:
-            logging.debug("Unexpected error ack() selectedimage: %s" %
-                            sys.exc_info()[1])
-            raise
-
-        # Generate the rest of the BSDP[SELECT] ACK packet by encoding the
-        #   name of the kernel (file), the TFTP path and the vendor encapsulated
-        #   options:
-        #   - [1,1,2] = BSDP message type (1), length (1), value (2 = select)
-        #   - [8,4] = BSDP selected_image (8), length (4), encoded image ID
+            logging.warning('Error replaying packet %d: %s' %
+                            (requests, sys.exc_info()[1]))
+            errors += 1
+            reply = None
+        elapsed += time.time() - begin
+
+        if reply is None:
+            reply = ('', ('0.0.0.0', 0))
+        replies.append(reply)
+        if record is not None:
+            record.write(reply[0], reply[1], timestamp)
+
+    if record is not None:
+        record.close()
+
+    answered = len([data for data, address in replies if data])
+    print 'Replayed %d packets: %d replies, %d errors' % \
+        (requests, answered, errors)
+    if elapsed > 0:
+        print 'Reply engine time %.3fs, %.0f packets/s' % \
+            (elapsed, requests / elapsed)
+
+    if goldenpath:
+        golden = [(data, address) for timestamp, address, data
+                  in readCapture(goldenpath)]
+        differences = [i for i in range(max(len(golden), len(replies)))
+                       if i >= len(golden) or i >= len(replies) or
+                       golden[i] != replies[i]]
+        print 'Compared with %s: %d identical, %d different' % \
+            (goldenpath, max(len(golden), len(replies)) - len(differences),
+             len(differences))
+        for i in differences[:20]:
+            print '  packet %d differs' % (i + 1)
+        return len(differences) == 0
+
+    return True
+
+
+def parseMacAddress(macaddr):
+    """
+        The parseMacAddress() function turns a MAC address written with ':',
+        '-' or '.' separators or none at all into a list of six ints. Octets
+        of colon or dash separated addresses may omit their leading zero.
+        Raises ValueError for anything that is not 12 hex digits.
+    """
+    digits = macaddr.strip()
+    for separator in ':-':
+        octets = digits.split(separator)
+        if len(octets) == 6 and \
+           len([octet for octet in octets if 1 <= len(octet) <= 2]) == 6:
+            digits = ''.join([octet.zfill(2) for octet in octets])
+            break
+    for separator in ':-.':
+        digits = digits.replace(separator, '')
+
+    if len(digits) != 12 or \
+       not set(digits.lower()) <= set('0123456789abcdef'):
+        raise ValueError('invalid MAC address "%s"' % macaddr)
+    return [int(digits[i:i+2], 16) for i in range(0, 12, 2)]
+
+
+def readInventory(path):
+    """
+        The readInventory() function reads an inventory file and returns a
+        list of (model, mac) tuples. MAC addresses are formatted the way
+        chaddr_to_mac() formats those of BSDP clients so they match what the
+        server sees. Raises ValueError naming the CSV line or JSON entry of
+        anything that is not a model and a valid MAC address.
+    """
+    entries = []
+    inventoryfile = open(path, 'rb')
+    try:
+        if path.lower().endswith('.json'):
+            for number, entry in enumerate(json.load(inventoryfile)):
+                entries.append(('entry %d' % (number + 1), entry))
+        else:
+            reader = csv.DictReader(inventoryfile)
+            for entry in reader:
+                entries.append(('line %d' % reader.line_num, entry))
+    finally:
+        inventoryfile.close()
+
+    inventory = []
+    for where, entry in entries:
+        # Rows with more fields than the header (an unquoted model with a
+        #   comma) end up under the None key, rows with fewer get None values
+        if not isinstance(entry, dict) or None in entry:
+            raise ValueError('%s %s: expected a model and a MAC address' %
+                                (path, where))
+        for key in ['model', 'mac']:
+            if not isinstance(entry.get(key), basestring) or \
+               not entry[key].strip():
+                raise ValueError('%s %s: missing %s' % (path, where, key))
         try:
-            bsdpack.SetOption("file",
-                strlist(booterfile.ljust(128,'\x00')).list())
-            bsdpack.SetOption("root_path", strlist(rootpath).list())
-            bsdpack.SetOption("vendor_encapsulated_options",
-                strlist([1,1,2,8,4] + selectedimage).list())
-        except:
-            logging.debug("Unexpected error ack() select SetOption: %s" %
-                            sys.exc_info()[1])
-            raise
+            octets = parseMacAddress(entry['mac'])
+        except ValueError, e:
+            raise ValueError('%s %s: %s' % (path, where, e))
+        inventory.append((entry['model'].strip(), chaddr_to_mac(octets)))
+    return inventory
+
 
+def evaluateInventory(tftprootpath, inventorypath, previouspath=None,
+                      reportpath=None, asjson=False):
+    """
+        The evaluateInventory() function loads the NBI catalog once, evaluates
+        the entitlements and default image of every Mac in an inventory file
+        and writes a report with one row per Mac. When previouspath is given
+        the entitlements under that NBI root path are evaluated as well and
+        each row shows whether they changed, and which images were added and
+        removed. Image IDs are reported sorted, since the order NBIs are found
+        in depends on the filesystem.
+    """
+    inventory = readInventory(inventorypath)
+
+    catalogs = [compileEntitlementIndex(getNbiOptions(tftprootpath)[0])]
+    if previouspath:
+        catalogs.append(compileEntitlementIndex(
+                        getNbiOptions(previouspath)[0]))
+
+    rows = []
+    changed = 0
+    for clientsysid, clientmacaddr in inventory:
+        row = {'model': clientsysid, 'mac': clientmacaddr}
+        results = []
+        for index in catalogs:
+            nbientitlements = evaluateEntitlement(index, clientsysid,
+                                                  clientmacaddr)
+            results.append((sorted([image['id'] for image in nbientitlements]),
+                            defaultImageId(nbientitlements)))
+
+        row['images'], row['default'] = results[0]
+        if previouspath:
+            row['previous_images'], row['previous_default'] = results[1]
+            row['added_images'] = [imageid for imageid in row['images']
+                                   if imageid not in row['previous_images']]
+            row['removed_images'] = [imageid for imageid in
+                                     row['previous_images']
+                                     if imageid not in row['images']]
+            row['changed'] = results[0] != results[1]
+            if row['changed']:
+                changed += 1
+        rows.append(row)
+
+    fields = ['model', 'mac', 'images', 'default']
+    if previouspath:
+        fields += ['previous_images', 'previous_default', 'added_images',
+                   'removed_images', 'changed']
+
+    if reportpath:
+        reportfile = open(reportpath, 'wb')
+    else:
+        reportfile = sys.stdout
+    try:
+        if asjson or (reportpath and reportpath.lower().endswith('.json')):
+            json.dump(rows, reportfile, indent=1, sort_keys=True)
+        else:
+            writer = csv.DictWriter(reportfile, fields)
+            writer.writerow(dict(zip(fields, fields)))
+            for row in rows:
+                row = dict(row)
+                for field in ['images', 'previous_images', 'added_images',
+                              'removed_images']:
+                    if field in row:
+                        row[field] = ' '.join([str(i) for i in row[field]])
+                writer.writerow(row)
+    finally:
+        if reportpath:
+            reportfile.close()
+
+    # Summarize to stderr so the report itself can go to stdout
+    summary = 'Evaluated %d Macs against %d images' % \
+        (len(rows), len(catalogs[0]['images']))
+    if previouspath:
+        summary += ', %d with changed entitlements' % changed
+    sys.stderr.write(summary + '\n')
+
+
+def createEngine(arguments, nbiimages, onselect=None, popularity=None,
+                 serverip_str=None):
+    """
+        The createEngine() function works out the server's IP address and
+        boot image URL from the command line arguments and the environment,
+        and returns a BsdpEngine serving nbiimages with them. A serverip_str
+        that is given is used instead of looking up the interface address.
+    """
+    bootproto = arguments['--proto']
+    serverinterface = arguments['--iface']
+    if serverip_str is None:
+        serverip_str = getServerAddress(serverinterface)
+
+    nbiurl = None
+    if 'http' in bootproto and os.environ.get('DOCKER_BSDPY_NBI_URL'):
+        nbiurl = urlparse(os.environ.get('DOCKER_BSDPY_NBI_URL'))
+
+    engine = BsdpEngine(nbiimages, serverip_str, bootproto,
+                        arguments['--path'], nbiurl, onselect, popularity)
+
+    logging.debug('Server IP: ' + serverip_str + '\n' +
+                  'Server FQDN: ' + engine.serverhostname + '\n' +
+                  'Serving on ' + serverinterface + '\n' +
+                  'Using ' + bootproto + ' to serve boot image.\n')
+    return engine
+
+
+def loadCatalog(tftprootpath, catalogpath=None):
+    """
+        The loadCatalog() function returns the catalog to serve, either the
+        compiled catalog at catalogpath or the NBIs found under tftprootpath
+        by getNbiOptions(), along with the list of its NBIs and a list of
+        where they came from for the log.
+    """
+    if catalogpath:
+        catalog = MappedCatalog(catalogpath)
+        nbiimages = catalog.images
+        nbisources = ['%s (generation %d): %s' %
+                      (catalogpath, catalog.generation, image['name'])
+                      for image in nbiimages]
+        return catalog, nbiimages, nbisources
+
+    nbiimages, nbisources = getNbiOptions(tftprootpath)
+    return nbiimages, nbiimages, nbisources
+
+
+def getRunningPid(pidfile):
+    """
+        The getRunningPid() function returns the process ID of the server
+        running under pidfile, otherwise None. A running server keeps its
+        pidfile locked, see writePidFile(), so the PID left behind by a server
+        that crashed is never taken for a running server, even once another
+        process has been given the same PID.
+    """
+    try:
+        pidfd = open(pidfile)
+    except IOError:
+        return None
+    try:
         try:
-            # Some debugging to stdout
-            logging.debug('-=========================================-')
-            logging.debug("Return ACK[SELECT] to " +
-                          str(clientip) +
-                          ' on ' +
-                          str(replyport))
-            logging.debug("--> TFTP path: %s\n-->Boot image URI: %s"
-                          % (str(strlist(bsdpack.GetOption("file"))), str(rootpath)))
-        except:
-            logging.debug("Unexpected error ack() select print debug: %s" %
-                            sys.exc_info()[1])
-            raise
+            fcntl.flock(pidfd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+        except IOError, e:
+            if e.errno not in (errno.EAGAIN, errno.EACCES): raise
+            try:
+                return int(pidfd.read().strip())
+            except ValueError:
+                return None
+        # Nobody holds the lock, the pidfile is stale
+        return None
+    finally:
+        pidfd.close()
 
-    # Return the finished packet, client IP and reply port back to the caller
-    return bsdpack, clientip, replyport
 
-imagenameslist = []
-nbiimages = []
-defaultnbi = 0
-hasdefault = False
+def writePidFile(pidfile):
+    """
+        The writePidFile() function writes our process ID to a new file, locks
+        it and renames it over pidfile, so a server being taken over keeps the
+        lock on its own pidfile until it exits. Returns the open file, which
+        holds the lock for as long as it is kept open.
+    """
+    temppath = '%s.%d.tmp' % (pidfile, os.getpid())
+    pidfd = open(temppath, 'w')
+    fcntl.flock(pidfd, fcntl.LOCK_EX)
+    pidfd.write(str(os.getpid()))
+    pidfd.flush()
+    os.rename(temppath, pidfile)
+    return pidfd
 
 
-def main():
-    """Main routine. Do the work."""
+def waitForExit(pid, timeout=30):
+    """
+        The waitForExit() function waits up to timeout seconds for a process to
+        exit and returns True if it did.
+    """
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            os.kill(pid, 0)
+        except OSError:
+            return True
+        time.sleep(0.1)
+    return False
 
-    # # First, write a PID so we can monitor the process
-    # pid = str(os.getpid())
-    # pidfile = "/var/run/bspdserver.pid"
-    #
-    # if os.path.isfile(pidfile):
-    #     print "%s already exists, exiting" % pidfile
-    #     sys.exit()
-    # else:
-    #     file(pidfile, 'w').write(pid)
+
+def main(arguments):
+    """Main routine. Do the work."""
 
     # Some logging preamble
     logging.debug('\n\n-=- Starting new BSDP server session -=-\n')
 
-    # We are changing nbiimages for use by other functions
-    global nbiimages
-
-    # Instantiate a basic pydhcplib DhcpServer class using netopts (listen port,
-    #   reply port and listening IP)
-    server = Server(netopt)
+    # Set the root path that NBIs will be served out of, either provided at
+    #  runtime or using a default if none was given. Defaults to /nbi.
+    tftprootpath = arguments['--path']
+    catalogpath = arguments['--catalog']
+    prewarmbudget = int(arguments['--prewarm']) * 1024 * 1024
+
+    # Since port 67 is bound with SO_REUSEPORT, the pidfile is what keeps a
+    #   second server from starting next to a running one, unless it was asked
+    #   to take over from it
+    pidfile = arguments['--pidfile']
+    oldpid = getRunningPid(pidfile)
+    if oldpid is not None and not arguments['--takeover']:
+        logging.debug('Server already running as PID %d, exiting' % oldpid)
+        sys.exit('BSDPy is already running as PID %d, use --takeover to '
+                 'replace it or another --pidfile to run next to it' % oldpid)
 
     # Do a one-time discovery of all available NBIs on the server. NBIs added
     #   after the server was started will not be picked up until after a restart
-    nbiimages, nbisources = getNbiOptions(tftprootpath)
+    #   or a USR1 signal. When taking over this happens before we bind, so the
+    #   old server keeps answering while we scan. With a compiled catalog the
+    #   NBIs are read from it instead, and new generations are picked up as
+    #   they are published.
+    catalog, nbiimages, nbisources = loadCatalog(tftprootpath, catalogpath)
+
+    # Count how often each image is selected, which decides the order of image
+    #   lists and which images are prewarmed first
+    popularity = {}
+
+    # Start pulling the default images into the page cache, other images are
+    #   prewarmed when a client first selects them
+    prewarmer = None
+    if prewarmbudget > 0:
+        prewarmer = ImagePrewarmer(prewarmbudget, popularity)
+        prewarmer.scan(nbiimages)
+
+    # Worker threads select images concurrently, so the counts are updated
+    #   under a lock to not lose any
+    popularitylock = threading.Lock()
+
+    def onselect(image):
+        popularitylock.acquire()
+        try:
+            popularity[image['id']] = popularity.get(image['id'], 0) + 1
+        finally:
+            popularitylock.release()
+        if prewarmer is not None:
+            prewarmer.select(image)
+
+    # The engine answering requests is kept in a dict so scan_nbis() can swap
+    #   in a new one, the workers pick it up with the next packet they handle
+    current = {'engine': createEngine(arguments, catalog, onselect,
+                                      popularity),
+               'catalog': catalog}
 
-    def scan_nbis(signal, frame):
-        global nbiimages
+    # Instantiate a basic pydhcplib DhcpServer class using netopts (listen port,
+    #   reply port and listening IP). If the server we take over from did not
+    #   bind with SO_REUSEPORT (the platform lacks it), all we can do is stop
+    #   it first. A server that wrote no pidfile, like releases before
+    #   --takeover, can not be found and has to be stopped by hand.
+    try:
+        server = Server(netopt)
+    except socket.error:
+        if oldpid is None:
+            if arguments['--takeover']:
+                logging.debug('Unable to bind (%s) and no server to take over '
+                              'from in %s' % (sys.exc_info()[1], pidfile))
+                sys.exit('Port 67 is in use by a server that did not write %s, '
+                         'stop it before starting BSDPy' % pidfile)
+            raise
+        logging.debug('Unable to bind next to PID %d (%s), stopping it first'
+                        % (oldpid, sys.exc_info()[1]))
+        os.kill(oldpid, signal.SIGTERM)
+        waitForExit(oldpid)
+        oldpid = None
+        server = Server(netopt)
+
+    if arguments['--bpf']:
+        server.AttachBsdpFilter()
+    capture = None
+    if arguments['--capture']:
+        capture = PacketCapture(arguments['--capture'])
+        logging.debug('Capturing received BSDP packets to ' +
+                        arguments['--capture'])
+
+    # We are ready to answer requests, write our PID and let the old server
+    #   drain its queue and exit
+    pidfd = writePidFile(pidfile)
+    if oldpid is not None:
+        logging.debug('Taking over from PID %d' % oldpid)
+        os.kill(oldpid, signal.SIGTERM)
+
+    def update_catalog():
         logging.debug('[========= Updating boot images list =========]')
-        nbiimages, nbisources = getNbiOptions(tftprootpath)
+        catalog, nbiimages, nbisources = loadCatalog(tftprootpath, catalogpath)
         for nbi in nbisources:
             logging.debug(nbi)
         logging.debug('[=========      End updated list     =========]')
+        current['engine'] = current['engine'].withCatalog(catalog)
+        current['catalog'] = catalog
+        if prewarmer is not None:
+            prewarmer.scan(nbiimages)
+
+    def scan_nbis(signal, frame):
+        update_catalog()
 
     signal.signal(signal.SIGUSR1, scan_nbis)
     signal.siginterrupt(signal.SIGUSR1, False)
 
+    # A USR2 signal logs the packet counters, including how many packets the
+    #   BPF filter kept from waking us up
+    signal.signal(signal.SIGUSR2, lambda signal, frame: server.LogStatistics())
+    signal.siginterrupt(signal.SIGUSR2, False)
+
+    # A TERM signal, from a new server taking over or from the init system,
+    #   makes us stop listening once the packets already received are handled.
+    #   It is left to interrupt select() so the main loop notices right away.
+    draining = threading.Event()
+
+    def drain(signal, frame):
+        logging.debug('Received TERM signal, draining requests and exiting')
+        draining.set()
+
+    signal.signal(signal.SIGTERM, drain)
+
     # Print the full list of eligible NBIs to the log
     logging.debug('[========= Using the following boot images =========]')
     for nbi in nbisources:
         logging.debug(nbi)
     logging.debug('[=========     End boot image listing      =========]')
 
-    # Loop while the looping's good.
+    # Requests are answered by a pool of worker threads. They are fed through a
+    #   bounded queue so a storm of requests gets dropped instead of piling up.
+    requests = Queue.Queue(int(arguments['--queue']))
+
+    def worker():
+        while True:
+            packet = requests.get()
+            try:
+                reply = current['engine'].handle(packet)
+                if reply is not None:
+                    # Once we have a finished DHCP packet, send it to the client
+                    bsdpack, clientip, replyport = reply
+                    server.SendDhcpPacketTo(bsdpack, str(clientip), replyport)
+            except:
+                # Error? Log it and keep going.
+                logging.debug('Unexpected error handling packet: %s' %
+                                sys.exc_info()[1])
+            requests.task_done()
+
+    for i in range(int(arguments['--workers'])):
+        thread = threading.Thread(target=worker)
+        thread.daemon = True
+        thread.start()
+
+    # Loop while the looping's good. Once draining, only read what is already
+    #   waiting on the socket. When it is empty, wait for the workers to answer
+    #   what was queued and check once more for packets that arrived in the
+    #   meantime, since we keep receiving our share of them until we close.
+    nextcheck = time.time() + 1
+    drained = False
     while True:
+        if draining.isSet():
+            timeout = 0
+        else:
+            timeout = 60
 
-        # Listen for DHCP packets. Since select() is used upstream we need to
-        #   catch the EINTR signal it trips on when we receive a USR1 signal to
-        #   reload the nbiimages list.
+        # Listen for DHCP packets. Since select() is used we need to catch the
+        #   EINTR signal it trips on when we receive a signal.
         try:
-            packet = server.GetNextDhcpPacket()
+            packet = server.GetNextDhcpPacket(timeout)
         except select.error, e:
             if e[0] != errno.EINTR: raise
-
+            continue
+
+        if packet is None and draining.isSet():
+            if drained:
+                break
+            requests.join()
+            drained = True
+            continue
+        drained = False
+
+        # Look for a catalog of another generation at most once a second. If
+        #   it can not be loaded the current one is kept and loading is retried.
+        if catalogpath and time.time() >= nextcheck:
+            nextcheck = time.time() + 1
+            if current['catalog'].isStale():
+                try:
+                    update_catalog()
+                except (IOError, OSError, ValueError, struct.error):
+                    logging.debug('Unable to load catalog %s: %s' %
+                                    (catalogpath, sys.exc_info()[1]))
+
+        # Only packets with BSDP options are worth handing to the workers
+        if packet is None or \
+           len(packet.GetOption('vendor_encapsulated_options')) <= 2:
+            continue
+
+        server.counters['bsdp'] += 1
+        if capture is not None:
+            capture.write(packet.data, packet.source_address)
         try:
-            # Check to see if any vendor_encapsulated_options are present
-            if len(packet.GetOption('vendor_encapsulated_options')) > 1:
-
-                # If we have vendor_encapsulated_options check for a value of 1
-                #   which in BSDP terms means the packet is a BSDP[LIST] request
-                if packet.GetOption('vendor_encapsulated_options')[2] == 1:
-                    logging.debug('-=========================================-')
-                    logging.debug('Got BSDP INFORM[LIST] packet: ')
-
-                    # Pass ack() the matching packet, defaultnbi and 'list'
-                    bsdplistack, clientip, replyport = ack(packet,
-                                                            defaultnbi,
-                                                            'list')
-                    # Once we have a finished DHCP packet, send it to the client
-                    server.SendDhcpPacketTo(bsdplistack, str(clientip),
-                                                            replyport)
-
-                # If the vendor_encapsulated_options BSDP type is 2, we process
-                #   the packet as a BSDP[SELECT] request
-                elif packet.GetOption('vendor_encapsulated_options')[2] == 2:
-                    logging.debug('-=========================================-')
-                    logging.debug('Got BSDP INFORM[SELECT] packet: ')
-
-
-                    bsdpselectack, selectackclientip, selectackreplyport = \
-                        ack(packet, None, 'select')
-
-                    # Once we have a finished DHCP packet, send it to the client
-                    server.SendDhcpPacketTo(bsdpselectack,
-                                            str(selectackclientip),
-                                            selectackreplyport)
-                # If the packet length is 7 or less, move on, BSDP packets are
-                #   at least 8 bytes long.
-                elif len(packet.GetOption('vendor_encapsulated_options')) <= 7:
-                    pass
-        except:
-            # Error? No worries, keep going.
-            pass
+            requests.put(packet, draining.isSet())
+        except Queue.Full:
+            server.counters['dropped'] += 1
+            logging.debug('Request queue is full, dropping packet from %s' %
+                            str(packet.source_address))
+
+    # Every queued request has been answered, so the socket the workers reply
+    #   through can be closed
+    server.LogStatistics()
+    server.dhcp_socket.close()
+    if capture is not None:
+        capture.close()
+
+    # Remove our pidfile, unless a server taking over already replaced it
+    try:
+        if os.path.samestat(os.fstat(pidfd.fileno()), os.stat(pidfile)):
+            os.unlink(pidfile)
+    except OSError:
+        pass
+    pidfd.close()
+    logging.debug('-=- BSDP server session ended -=-')
 
 if __name__ == '__main__':
-    main()
+    arguments = docopt(usage, version='0.0.1')
+
+    # The offline modes can run as any user, so they only log what matters to
+    #   standard error instead of writing to the server log
+    if arguments['--evaluate'] or arguments['--publish'] or \
+       arguments['--replay']:
+        logging.basicConfig(format='%(levelname)s: %(message)s',
+                            level=logging.WARNING)
+    else:
+        logging.basicConfig(format='%(asctime)s - %(levelname)s: %(message)s',
+                            level=logging.DEBUG,
+                            filename='/var/log/bsdpserver.log',
+                            datefmt='%m/%d/%Y %I:%M:%S %p')
+
+    if arguments['--evaluate']:
+        try:
+            evaluateInventory(arguments['--path'], arguments['--evaluate'],
+                              arguments['--previous'], arguments['--report'],
+                              arguments['--json'])
+        except ValueError, e:
+            sys.exit(str(e))
+    elif arguments['--publish']:
+        generation = publishCatalog(getNbiOptions(arguments['--path'])[0],
+                                    arguments['--publish'])
+        sys.stderr.write('Published catalog generation %d to %s\n' %
+                         (generation, arguments['--publish']))
+    elif arguments['--replay']:
+        engine = createEngine(arguments,
+                              getNbiOptions(arguments['--path'])[0],
+                              serverip_str=os.environ.get('DOCKER_BSDPY_IP')
+                                           or REPLAYSERVERIP)
+        if not replay(engine, arguments['--replay'],
+                      float(arguments['--speed']), arguments['--record'],
+                      arguments['--golden']):
+            sys.exit(1)
+    else:
+        main(arguments)